@@ -0,0 +1,339 @@
+# region Imports
+import os
+import sys
+import pathlib
+import importlib.util
+import tempfile
+import shutil
+import subprocess
+import datetime
+import platform
+import time
+import json
+import numpy as np
+from PIL import Image
+import PIL
+import cv2
+
+# endregion
+
+# region User Settings
+
+# Which script to benchmark ("main.py" or "main-audio.py")
+script = "main-audio.py"
+
+# Size of the synthetic photo library
+photo_count = 200
+photo_width = 1920
+photo_height = 1080
+
+# Share of the photos that get exif data (the rest use their modified time)
+exif_share = 0.5
+
+# Share of the photos that are a different size (exercises getImageSize and the cover crop)
+mixed_size_share = 0.2
+
+# Seed so every run makes the same library
+random_seed = 1
+
+# Where the results are written (json so runs can be compared between versions)
+output_file = "benchmark.json"
+
+# Keep the generated library afterwards
+keep_library = False
+
+# endregion User Settings
+
+
+# region Code
+
+
+# Loads one of the timelapse scripts as a module without running it
+def loadScript(script_path):
+    module_name = script_path.stem.replace("-", "_")
+    spec = importlib.util.spec_from_file_location(module_name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so process pools can find the functions again
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# Folder the timelapse scripts are in
+root = pathlib.Path(__file__).resolve().parent
+
+# The script being benchmarked, loaded when this file is imported since that's how spawned worker processes (Windows and macOS)
+# get it registered too (the script's name can't be imported on its own)
+module = loadScript(pathlib.Path.joinpath(root, script))
+
+
+# Makes a synthetic photo library
+def createLibrary(library_directory) -> None:
+    photo_directory = pathlib.Path.joinpath(library_directory, "photos")
+    pathlib.Path.mkdir(photo_directory, parents=True)
+    rng = np.random.default_rng(random_seed)
+    first_day = datetime.datetime(2024, 1, 1, 8, 0, 0)
+    for n in range(photo_count):
+        # Most photos share a size, some don't
+        size = (photo_width, photo_height)
+        if rng.random() < mixed_size_share:
+            size = (photo_height, photo_width)
+        # A smooth gradient with some noise so the files compress like photos
+        x = np.linspace(0, 255, size[0], dtype=np.float32)
+        y = np.linspace(0, 255, size[1], dtype=np.float32)[:, None]
+        base = (x + y + n * 3) % 256
+        pixels = np.stack([base, np.roll(base, n, axis=1), 255 - base], axis=2)
+        pixels += rng.normal(0, 8, pixels.shape).astype(np.float32)
+        im = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+        # One photo a day at a slightly different time
+        taken = first_day + datetime.timedelta(
+            days=n, minutes=int(rng.integers(0, 600))
+        )
+        path = pathlib.Path.joinpath(photo_directory, f"photo_{n:05d}.jpg")
+        if rng.random() < exif_share:
+            exif = Image.Exif()
+            exif[0x0132] = taken.strftime("%Y:%m:%d %H:%M:%S")
+            # The scripts read ImageLength as the width and ImageWidth as the height
+            exif[0x0101] = size[0]
+            exif[0x0100] = size[1]
+            im.save(path, exif=exif)
+        else:
+            im.save(path)
+        os.utime(path, (taken.timestamp(), taken.timestamp()))
+
+
+# Makes some synthetic audio that's longer than the video
+def createAudio(library_directory, duration) -> None:
+    audio_directory = pathlib.Path.joinpath(library_directory, "audio")
+    pathlib.Path.mkdir(audio_directory)
+    for n, frequency in enumerate((440, 660)):
+        audio_out = pathlib.Path.joinpath(audio_directory, f"tone_{n}.wav")
+        terms = ["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi"]
+        terms += ["-i", f"sine=frequency={frequency}:duration={duration}"]
+        subprocess.run(terms + [str(audio_out)], check=True)
+
+
+# Empties a folder (keeping the folder itself)
+def clearDirectory(directory) -> None:
+    shutil.rmtree(directory)
+    pathlib.Path.mkdir(directory)
+
+
+# Times a stage and records how fast it went (the cpu time includes finished worker processes)
+def timeStage(results, name, function, photos=None, frames=None):
+    start = time.perf_counter()
+    cpu_start = sum(os.times()[:4])
+    try:
+        value = function()
+        error = None
+    except Exception as e:
+        value = None
+        error = repr(e)
+    seconds = time.perf_counter() - start
+    result = {
+        "seconds": seconds,
+        "cpu_seconds": sum(os.times()[:4]) - cpu_start,
+    }
+    if photos is not None:
+        result["photos_per_second"] = photos / seconds
+    if frames is not None:
+        result["frames_per_second"] = frames / seconds
+    if error is not None:
+        result["error"] = error
+    results[name] = result
+    print(f"{name}: {seconds:.3f}s" + (f" ({error})" if error else ""))
+    return value
+
+
+# Runs every stage of the script on the library
+def runStages(module, library_directory) -> dict:
+    results = {}
+    photo_directory = pathlib.Path.joinpath(library_directory, "photos")
+    output_directory = pathlib.Path.joinpath(library_directory, "timelapse")
+    temp_directory = pathlib.Path.joinpath(library_directory, "temp")
+    render_cache_directory = pathlib.Path.joinpath(library_directory, "render_cache")
+    audio_directory = pathlib.Path.joinpath(library_directory, "audio")
+    json_fix = pathlib.Path.joinpath(library_directory, "corrections.json")
+    image_index = pathlib.Path.joinpath(library_directory, "image_index.json")
+    for directory in (output_directory, temp_directory, render_cache_directory):
+        pathlib.Path.mkdir(directory)
+    # Reading the photos with nothing known about them, then again with the index
+    images = timeStage(
+        results,
+        "getImages",
+        lambda: module.getImages(photo_directory, image_index),
+        photos=photo_count,
+    )
+    images = timeStage(
+        results,
+        "getImages (indexed)",
+        lambda: module.getImages(photo_directory, image_index),
+        photos=photo_count,
+    )
+    # Finding near duplicates across the whole library, after hashing what every photo looks like (only timed, every photo is kept)
+    if hasattr(module, "getDuplicateGroups"):
+        remove_duplicates = module.remove_duplicates
+        module.remove_duplicates = True
+        images = timeStage(
+            results,
+            "getImages (image hashes)",
+            lambda: module.getImages(photo_directory, image_index),
+            photos=photo_count,
+        )
+        module.remove_duplicates = remove_duplicates
+        timeStage(
+            results,
+            "getDuplicateGroups",
+            lambda: module.getDuplicateGroups(images),
+            photos=photo_count,
+        )
+
+    # Checking and fixing the dates (the library has no duplicate times so nothing is asked)
+    def checkAndFix():
+        date_corrections = module.getDateCorrections(json_fix)
+        date_corrections = module.checkDates(images, date_corrections, json_fix)
+        return module.fixPhotoDates(images, date_corrections, library_directory)
+
+    images = timeStage(
+        results, "checkDates/fixPhotoDates", checkAndFix, photos=photo_count
+    )
+    images.sort()
+    # Hashing the contents of the photos the caches are keyed on
+    if hasattr(module, "hashImages"):
+        timeStage(
+            results,
+            "hashImages",
+            lambda: module.hashImages(images, image_index),
+            photos=photo_count,
+        )
+    # Lining the photos up, then again with the transforms saved (only timed, the frames aren't lined up)
+    if hasattr(module, "getAlignments"):
+        alignment_file = pathlib.Path.joinpath(library_directory, "alignment.json")
+        for name in ("getAlignments", "getAlignments (saved)"):
+            timeStage(
+                results,
+                name,
+                lambda: module.getAlignments(images, alignment_file),
+                photos=photo_count,
+            )
+    # Measuring the exposure of every photo, then again with the levels saved (only timed, the frames aren't evened out)
+    if hasattr(module, "getExposureCorrections"):
+        exposure_file = pathlib.Path.joinpath(library_directory, "exposure.json")
+        for name in ("getExposureCorrections", "getExposureCorrections (saved)"):
+            timeStage(
+                results,
+                name,
+                lambda: module.getExposureCorrections(images, exposure_file),
+                photos=photo_count,
+            )
+    scale_size = module.getImageSize(images)
+    if hasattr(module, "getOutputSize"):
+        scale_size = module.getOutputSize(scale_size)
+    frame_count = photo_count * module.length_per_image
+    # Rendering every frame, then again with all of them cached
+    jobs = module.getFrameJobs(images, scale_size, None)
+    timeStage(
+        results,
+        "createImages",
+        lambda: module.createImages(jobs, temp_directory, scale_size),
+        photos=photo_count,
+    )
+    cached_jobs = module.getFrameJobs(images, scale_size, render_cache_directory)
+    # The temp folder is emptied before each pass since frames already in it are skipped
+    clearDirectory(temp_directory)
+    module.createImages(cached_jobs, temp_directory, scale_size)
+    clearDirectory(temp_directory)
+    timeStage(
+        results,
+        "createImages (cached)",
+        lambda: module.createImages(cached_jobs, temp_directory, scale_size),
+        photos=photo_count,
+    )
+    # Encoding the rendered frames
+    video_out = pathlib.Path.joinpath(output_directory, "timelapse.mp4")
+    timeStage(
+        results,
+        "createVideo",
+        lambda: module.createVideo(
+            module.readImages(jobs, temp_directory), video_out, scale_size
+        ),
+        frames=frame_count,
+    )
+    if not hasattr(module, "createVideoFF"):
+        return results
+    if shutil.which("ffmpeg") is None:
+        print("FFmpeg wasn't found so the FFmpeg stages were skipped")
+        return results
+    ff_video_out = pathlib.Path.joinpath(output_directory, "timelapse_ff.mp4")
+    timeStage(
+        results,
+        "createVideoFF",
+        lambda: module.createVideoFF(
+            module.readImages(jobs, temp_directory), ff_video_out, scale_size
+        ),
+        frames=frame_count,
+    )
+    # Trying every encoder on the first photos like the auto encoder does
+    if hasattr(module, "pickEncoder"):
+        timeStage(
+            results,
+            "pickEncoder",
+            lambda: module.pickEncoder(jobs, scale_size, temp_directory),
+        )
+    # Adding local synthetic audio
+    createAudio(library_directory, frame_count / module.fps + 10)
+    duration = frame_count / module.fps
+    audio = timeStage(
+        results,
+        "combineAudio",
+        lambda: module.combineAudio(audio_directory, duration),
+    )
+    timeStage(
+        results,
+        "addAudio",
+        lambda: module.addAudio(output_directory, *audio),
+        frames=frame_count,
+    )
+    return results
+
+
+# Main function for running everything
+def main() -> None:
+    library_directory = pathlib.Path(tempfile.mkdtemp(prefix="timelapse_benchmark_"))
+    try:
+        print(f"Creating {photo_count} photos in {library_directory}")
+        createLibrary(library_directory)
+        results = runStages(module, library_directory)
+    finally:
+        if not keep_library:
+            shutil.rmtree(library_directory)
+    # Everything needed to compare against another run
+    report = {
+        "script": script,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "library": {
+            "photo_count": photo_count,
+            "photo_width": photo_width,
+            "photo_height": photo_height,
+            "exif_share": exif_share,
+            "mixed_size_share": mixed_size_share,
+            "random_seed": random_seed,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        "stages": results,
+    }
+    with open(pathlib.Path.joinpath(root, output_file), "w+") as file:
+        file.write(json.dumps(report, indent=4))
+
+
+# Run the benchmark
+if __name__ == "__main__":
+    main()
+
+# endregion Code
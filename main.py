@@ -2,11 +2,25 @@
 import os
 import pathlib
 from PIL import Image, ExifTags, ImageOps, ImageDraw, ImageFont
-import time
 import datetime
 import json
 import cv2
 import shutil
+import hashlib
+import concurrent.futures
+import itertools
+import collections
+import numpy as np
+import io
+import fractions
+import time
+import contextlib
+import cProfile
+import tracemalloc
+import ctypes
+import ctypes.util
+import select
+import struct
 
 # endregion
 
@@ -16,6 +30,14 @@ import shutil
 fps = 30
 length_per_image = 2
 
+# Write every photo to the video once and hold it on screen with the frame rate (instead of writing it length_per_image times)
+# This lowers the frame rate of timelapse.mp4 to fps / length_per_image
+hold_frames = False
+
+# Frames at the end of each photo's time on screen spent fading into the next photo (0 for hard cuts, has to be less than length_per_image)
+# Fading makes every frame of the video so hold_frames doesn't apply
+crossfade_frames = 0
+
 # Enable what you want overlaying the videos
 add_day_count = True
 add_date = True
@@ -28,13 +50,75 @@ use_cheat_day = True
 # Do you have a specific first day you want to start at (This only matters if using the cheat day)
 specific_first_date = datetime.date(2024, 1, 1)
 
+# Number of threads used to read new photos (None lets Python pick)
+probe_workers = None
+
 # If files need rotated
 rotate_image = 0
 
+# Line every photo up with a reference photo so handheld photos don't jump around
+align_photos = False
+# Photo the others get lined up with ("first" or the name of a file in the photos folder)
+align_reference = "first"
+# Longest side the photos are matched at (smaller is faster but less exact)
+align_size = 800
+# Zoom in a little so the edges that get moved in when lining up are cropped off
+align_zoom = 1.05
+
+# Even out the exposure and colour of the photos so the timelapse doesn't flicker
+normalize_exposure = False
+# Number of days either side of each photo its exposure is evened out with (bigger is smoother but follows the seasons less)
+normalize_window = 7
+# How much of the correction gets applied (1 for all of it)
+normalize_strength = 1.0
+# Longest side the photos are measured at
+normalize_size = 256
+
+# Render the frames in parallel across processes
+parallel_render = True
+# Number of processes to render with (None uses every CPU core)
+render_workers = None
+
+# Most frames being read, rendered or waiting for the video at once when streaming (caps memory, None is two per render process)
+max_frames_in_flight = None
+# Threads reading photos ahead of the render processes when streaming
+reader_threads = 2
+
+# Keep memory use flat on very large libraries (frames are let go of as soon as they're replaced and only one frame per render process is in flight)
+low_memory = False
+
+# Keep the rendered frames between runs so only new or changed photos get rendered again (stored uncompressed so a reused frame is exactly the one that was rendered, around 6MB a frame at 1080p)
+use_render_cache = True
+
+# Send the frames straight into the video instead of saving them to the temp folder first
+stream_frames = True
+
+# Leave out photos that look nearly the same as another one (like accidental double shots)
+remove_duplicates = False
+# How different two photos can look and still count as the same (bits out of the 64 in their difference hash)
+duplicate_distance = 4
+# Only count photos taken within this many hours of each other as the same (None for anywhere in the library, daily photos can look alike)
+duplicate_within_hours = 1
+# Which photo of a group is kept ("first" taken, "last" taken or "largest" file)
+duplicate_keep = "first"
+
 # Do you want the files deleted after
 delete_temp = False
 delete_source = False
 
+# Keep running and remake the timelapse whenever photos are added, changed or removed
+# Dates can't be asked about while watching so photos with the same time are left as they are until the next normal run
+watch_mode = False
+# Seconds to wait after the last change before remaking it (so a burst of synced photos is only one update)
+watch_debounce = 5
+# Seconds between checking the folders when inotify isn't available (anywhere but Linux)
+watch_poll_interval = 10
+
+# Write a json report of how long each part of the run took to the timelapse folder
+write_report = True
+# Also profile the run ("cprofile" saves profile.prof next to the report, "tracemalloc" adds memory use to the report, None for neither)
+profile_mode = None
+
 # endregion User Settings
 
 
@@ -43,14 +127,25 @@ delete_source = False
 
 # Creating a class to store image information
 class ImageFiles:
+    # Fixed attributes so each photo doesn't carry its own dict (adds up on big libraries)
+    __slots__ = ("path", "creation", "width", "height", "file_hash", "image_hash")
+
     # Set it up
     def __init__(
-        self, path: pathlib, creation: datetime, width: int, height: int
+        self,
+        path: pathlib,
+        creation: datetime,
+        width: int,
+        height: int,
+        file_hash: str = None,
+        image_hash: str = None,
     ) -> None:
         self.path = path
         self.creation = creation
         self.width = width
         self.height = height
+        self.file_hash = file_hash
+        self.image_hash = image_hash
 
     # Get a readable string
     def __str__(self) -> str:
@@ -61,6 +156,117 @@ class ImageFiles:
         return self.creation < other.creation
 
 
+# What gets recorded for the report (each process keeps its own)
+run_report = {}
+
+
+# Clears the report for a new run
+def resetReport() -> None:
+    run_report.clear()
+    run_report["stages"] = {}
+    run_report["frames"] = []
+    run_report["commands"] = []
+    run_report["bytes_read"] = 0
+    run_report["bytes_written"] = 0
+    run_report["duplicates"] = []
+    run_report["skipped"] = []
+
+
+resetReport()
+
+
+# Times a stage of the run (the cpu time includes finished worker processes)
+@contextlib.contextmanager
+def timeStage(name):
+    start = time.perf_counter()
+    cpu_start = sum(os.times()[:4])
+    yield
+    run_report["stages"][name] = {
+        "wall_seconds": time.perf_counter() - start,
+        "cpu_seconds": sum(os.times()[:4]) - cpu_start,
+    }
+
+
+# Records how long a frame took and how much it read and wrote
+def recordFrame(stats) -> None:
+    seconds, bytes_read, bytes_written = stats
+    run_report["frames"].append(seconds)
+    run_report["bytes_read"] += bytes_read
+    run_report["bytes_written"] += bytes_written
+
+
+# Gets a marker for what has been recorded so far
+def getReportMark() -> tuple:
+    return (
+        len(run_report["frames"]),
+        len(run_report["commands"]),
+        run_report["bytes_read"],
+        run_report["bytes_written"],
+    )
+
+
+# Gets what has been recorded since a marker (so worker processes can send it back)
+def getReportSince(mark) -> dict:
+    return {
+        "frames": run_report["frames"][mark[0] :],
+        "commands": run_report["commands"][mark[1] :],
+        "bytes_read": run_report["bytes_read"] - mark[2],
+        "bytes_written": run_report["bytes_written"] - mark[3],
+    }
+
+
+# Adds what a worker process recorded to the report
+def mergeReport(part) -> None:
+    run_report["frames"] += part["frames"]
+    run_report["commands"] += part["commands"]
+    run_report["bytes_read"] += part["bytes_read"]
+    run_report["bytes_written"] += part["bytes_written"]
+
+
+# Writes the report to the timelapse folder
+def writeReport(output_directory) -> None:
+    report = {
+        "stages": run_report["stages"],
+        "bytes_read": run_report["bytes_read"],
+        "bytes_written": run_report["bytes_written"],
+        "commands": run_report["commands"],
+    }
+    # Photos that were left out for looking the same as another
+    if run_report["duplicates"]:
+        report["duplicates"] = run_report["duplicates"]
+    # Stages that were skipped because the last run already finished them
+    if run_report["skipped"]:
+        report["skipped"] = run_report["skipped"]
+    # Percentiles of how long each frame took to render
+    if run_report["frames"]:
+        frame_ms = np.array(run_report["frames"]) * 1000
+        report["frames"] = {
+            "count": len(frame_ms),
+            "mean_ms": float(frame_ms.mean()),
+            "p50_ms": float(np.percentile(frame_ms, 50)),
+            "p90_ms": float(np.percentile(frame_ms, 90)),
+            "p99_ms": float(np.percentile(frame_ms, 99)),
+            "max_ms": float(frame_ms.max()),
+        }
+    # Size of the videos that were made
+    report["outputs"] = {}
+    for output in output_directory.glob("*.mp4"):
+        report["outputs"][output.name] = output.stat().st_size
+    # Memory use if it was being traced
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        report["memory"] = {
+            "current_bytes": current,
+            "peak_bytes": peak,
+            "top": [str(stat) for stat in snapshot.statistics("lineno")[:10]],
+        }
+    writeTextFile(
+        pathlib.Path.joinpath(output_directory, "report.json"),
+        json.dumps(report, indent=4),
+    )
+
+
 # Loads date corrections from json
 def getDateCorrections(json_fix) -> dict:
     date_corrections = {}
@@ -74,68 +280,229 @@ def getDateCorrections(json_fix) -> dict:
     return date_corrections
 
 
-# Gets information about the photos
-def getImages(photo_directory) -> list:
-    # Create a list of files
-    images = []
-    # Getting every photo in the photos path
-    for image_x in photo_directory.iterdir():
-        # Check if it's a file
-        if not image_x.is_file():
-            continue
-        # Check if it's the correct type of image
-        if not image_x.suffix in (".jpg", ".png"):
-            continue
+# Gets a hash of the contents of a file
+def getFileHash(path) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# Loads the saved photo information from the last run
+def loadImageIndex(index_file) -> dict:
+    if pathlib.Path.exists(index_file):
+        with open(index_file, "r") as file:
+            return json.load(file)
+    return {}
+
+
+# Saves the photo information for the next run
+def saveImageIndex(image_index, index_file) -> None:
+    json_obj = json.dumps(image_index, indent=4, sort_keys=False)
+    writeTextFile(index_file, json_obj)
+
+
+# Gets the difference hash of a photo (whether each pixel of a tiny greyscale copy is brighter than the one next to it, so near identical photos get close hashes)
+def getImageHash(im) -> str:
+    # JPEGs get decoded at a fraction of the size since only 9x8 pixels are needed
+    im.draft("L", (64, 64))
+    tiny = im.convert("L").resize((9, 8), Image.Resampling.BOX)
+    pixels = np.asarray(tiny, dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes().hex()
+
+
+# Reads the information about a single photo (Pillow only reads the header when opening, the pixels are only decoded small for the image hash when removing duplicates)
+def probeImage(image_x, stat) -> dict:
+    with Image.open(image_x) as im:
         # Get file information (exif data) from Pillow
-        image_x_i = Image.open(image_x).getexif()
+        image_x_i = im.getexif()
         # Where to store readable keys
         temp_keys = {}
-        # Check if the image has exif data
-        if len(image_x_i) != 0:
-            # Transform the exif tags into readable keys
-            for key, val in image_x_i.items():
-                if key in ExifTags.TAGS:
-                    # Check if the key is one we want
-                    if ExifTags.TAGS[key] in ("DateTime", "ImageLength", "ImageWidth"):
-                        # Modifying the val if it's not an int (only will be datetime)
-                        if not isinstance(val, int):
-                            # Convert off of the exif date time format
-                            val = datetime.datetime.strptime(val, "%Y:%m:%d %H:%M:%S")
-                        # Add the keys
-                        temp_keys[ExifTags.TAGS[key]] = val
-        # We have to get this information from the file itself
-        else:
+        # Transform the exif tags into readable keys
+        for key, val in image_x_i.items():
+            if key in ExifTags.TAGS:
+                # Check if the key is one we want
+                if ExifTags.TAGS[key] in ("DateTime", "ImageLength", "ImageWidth"):
+                    # Modifying the val if it's not an int (only will be datetime)
+                    if not isinstance(val, int):
+                        # Convert off of the exif date time format
+                        val = datetime.datetime.strptime(val, "%Y:%m:%d %H:%M:%S")
+                    # Add the keys
+                    temp_keys[ExifTags.TAGS[key]] = val
+        # Anything missing from the exif data we have to get from the file itself
+        if "DateTime" not in temp_keys:
             # Get the last time the file was modified (closest we'll get to exif data because
             # the "creation time" [ctime] can be change by many actions while the "modified time"
             # [mtime] only changes if the content of the file itself is modified. "access time" [atime]
             # is useless for this use case.)
-            # Converting from the local date time representation since we just got it from there
-            modified_time = datetime.datetime.strptime(
-                time.ctime(os.path.getmtime(image_x)), "%c"
-            )
-            temp_keys["DateTime"] = modified_time
-            t_w, t_h = Image.open(image_x).size
+            # Dropping the microseconds since exif times don't have them either
+            temp_keys["DateTime"] = datetime.datetime.fromtimestamp(
+                stat.st_mtime
+            ).replace(microsecond=0)
+        if "ImageLength" not in temp_keys or "ImageWidth" not in temp_keys:
+            t_w, t_h = im.size
             # Yes length is width and width is height ... exif tags must be weird
             temp_keys["ImageLength"] = t_w
             temp_keys["ImageWidth"] = t_h
+        # Keep what we found along with the size and modified time it was found for
+        entry = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "creation": temp_keys["DateTime"].strftime("%Y-%m-%d %H:%M:%S"),
+            "width": temp_keys["ImageLength"],
+            "height": temp_keys["ImageWidth"],
+        }
+        # Only needed for finding duplicates (done last since it changes the size the photo is decoded at)
+        if remove_duplicates:
+            entry["image_hash"] = getImageHash(im)
+    return entry
+
+
+# Gets information about the photos
+def getImages(photo_directory, index_file) -> list:
+    # Load what we know about the photos from the last run
+    image_index = loadImageIndex(index_file)
+    new_image_index = {}
+    # Photos that are new or have changed since the last run
+    to_probe = []
+    # Getting every photo in the photos path
+    for image_x in photo_directory.iterdir():
+        # Check if it's a file
+        if not image_x.is_file():
+            continue
+        # Check if it's the correct type of image
+        if not image_x.suffix in (".jpg", ".png"):
+            continue
+        # Only read the photo if it's new or has changed since the last run
+        stat = image_x.stat()
+        entry = image_index.get(image_x.name)
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime"] != stat.st_mtime_ns
+            or (remove_duplicates and "image_hash" not in entry)
+        ):
+            to_probe.append((image_x, stat))
+        # Added now to keep the folder order (new photos get filled in below)
+        new_image_index[image_x.name] = entry
+    # Read the new photos with threads (it's mostly waiting on the disk)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=probe_workers) as pool:
+        probed = pool.map(lambda x: probeImage(*x), to_probe)
+        for (image_x, stat), entry in zip(to_probe, probed):
+            # Keep the content hash if only the image hash was missing
+            old_entry = new_image_index[image_x.name]
+            if (
+                old_entry is not None
+                and "hash" in old_entry
+                and old_entry["size"] == entry["size"]
+                and old_entry["mtime"] == entry["mtime"]
+            ):
+                entry["hash"] = old_entry["hash"]
+            new_image_index[image_x.name] = entry
+    # Create a list of files
+    images = []
+    for name, entry in new_image_index.items():
         # Get the data we want (creation, width, length)
         wanted_data = ImageFiles(
-            image_x,
-            temp_keys["DateTime"],
-            temp_keys["ImageLength"],
-            temp_keys["ImageWidth"],
+            pathlib.Path.joinpath(photo_directory, name),
+            datetime.datetime.strptime(entry["creation"], "%Y-%m-%d %H:%M:%S"),
+            entry["width"],
+            entry["height"],
+            entry.get("hash"),
+            entry.get("image_hash"),
         )
         # Add the image to the list
         images.append(wanted_data)
+    # Save the index (photos that are gone get dropped from it)
+    saveImageIndex(new_image_index, index_file)
     return images
 
 
+# Hashes the contents of the photos that haven't been yet (only the photos that are used, the caches are keyed on it)
+def hashImages(images, index_file) -> None:
+    to_hash = [x for x in images if x.file_hash is None]
+    if len(to_hash) == 0:
+        return
+    # Read the photos with threads like when probing them
+    paths = [x.path for x in to_hash]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=probe_workers) as pool:
+        for x, file_hash in zip(to_hash, pool.map(getFileHash, paths)):
+            x.file_hash = file_hash
+    # Save the hashes so they're only worked out once
+    image_index = loadImageIndex(index_file)
+    for x in to_hash:
+        if x.path.name in image_index:
+            image_index[x.path.name]["hash"] = x.file_hash
+    saveImageIndex(image_index, index_file)
+
+
+# Finds groups of photos that look nearly the same
+def getDuplicateGroups(images) -> list:
+    hashes = np.array([int(x.image_hash, 16) for x in images], dtype=np.uint64)
+    times = np.array([x.creation.timestamp() for x in images])
+    # Each photo starts in its own group
+    parent = list(range(len(images)))
+
+    # Gets the photo a group is known by
+    def find(n):
+        while parent[n] != n:
+            parent[n] = parent[parent[n]]
+            n = parent[n]
+        return n
+
+    # Split the hashes into one more band than the distance allowed, two photos that are close enough
+    # have to match exactly on at least one band so only photos sharing a band need comparing
+    bounds = np.linspace(0, 64, duplicate_distance + 2).astype(int)
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        band_mask = np.uint64((1 << int(high - low)) - 1)
+        bands = (hashes >> np.uint64(low)) & band_mask
+        order = np.argsort(bands, kind="stable")
+        sorted_bands = bands[order]
+        starts = np.flatnonzero(sorted_bands[1:] != sorted_bands[:-1]) + 1
+        for bucket in np.split(order, starts):
+            # Compare each photo in the bucket with the ones after it all at once
+            for n in range(len(bucket) - 1):
+                others = bucket[n + 1 :]
+                close = np.bitwise_count(hashes[others] ^ hashes[bucket[n]])
+                close = close <= duplicate_distance
+                if duplicate_within_hours is not None:
+                    gap = np.abs(times[others] - times[bucket[n]])
+                    close &= gap <= duplicate_within_hours * 3600
+                for other in others[close]:
+                    parent[find(other)] = find(bucket[n])
+    # Collect the groups with more than one photo
+    groups = collections.defaultdict(list)
+    for n in range(len(images)):
+        groups[find(n)].append(images[n])
+    return [x for x in groups.values() if len(x) > 1]
+
+
+# Leaves out all but one photo of each group that looks nearly the same
+def removeDuplicates(images) -> list:
+    removed = set()
+    for group in getDuplicateGroups(images):
+        if duplicate_keep == "last":
+            keep = max(group, key=lambda x: (x.creation, x.path.name))
+        elif duplicate_keep == "largest":
+            keep = max(group, key=lambda x: x.path.stat().st_size)
+        else:
+            keep = min(group, key=lambda x: (x.creation, x.path.name))
+        for x in group:
+            if x is not keep:
+                removed.add(x.path)
+                run_report["duplicates"].append(
+                    {"removed": x.path.name, "kept": keep.path.name}
+                )
+    return [x for x in images if x.path not in removed]
+
+
 # Corrects images that need their dates fixed
 def fixPhotoDates(images, date_corrections, root) -> list:
-    # Getting a list of the file paths that need updated
-    need_updated_paths = []
+    # Getting the file paths that need updated (a set so checking every photo stays quick)
+    need_updated_paths = set()
     for x in date_corrections:
-        need_updated_paths.append(pathlib.Path.joinpath(root, "photos", x))
+        need_updated_paths.add(pathlib.Path.joinpath(root, "photos", x))
     # Checking images that need to have their dates fixed
     for n, x in enumerate(images):
         if x.path in need_updated_paths:
@@ -143,30 +510,29 @@ def fixPhotoDates(images, date_corrections, root) -> list:
     return images
 
 
-def checkDates(images, date_corrections, json_fix) -> dict:
+def checkDates(images, date_corrections, json_fix, interactive=True) -> dict:
     # Here's a step to fix any issues in the dates. In my example pictures for some reason
     # a handful of pictures lost their modified time. So this step will be used to fix the
     # date time of those pictures.
     # From the images search for duplicate datetimes
-    date_time_count = {}
-    for x in images:
-        if date_time_count.get(x.creation) is None:
-            date_time_count[x.creation] = 1
-        else:
-            date_time_count[x.creation] += 1
-    # Sorting the dictionary. Kind of fucky honestly
-    sorted_count = sorted(date_time_count.items(), key=lambda x: x[1], reverse=True)
-    # Only getting returning dates with more than 1 date (because if the modification has been messed up it was probably to todays date)
-    output_sorted_count = []
-    for x in sorted_count:
-        if x[1] > 1:
-            output_sorted_count.append(x[0])
+    date_time_count = collections.Counter(x.creation for x in images)
+    # Only getting dates with more than 1 photo (because if the modification has been messed up it was probably to todays date)
+    duplicate_times = set()
+    for x, count in date_time_count.items():
+        if count > 1:
+            duplicate_times.add(x)
+    del date_time_count
     # Get the filenames to update
     pictures_to_update = []
     for x in images:
         # If the same datetime occurs more than once and it isn't already known about add it to get fixed by the user
-        if x.creation in output_sorted_count and x.path.name not in date_corrections:
+        if x.creation in duplicate_times and x.path.name not in date_corrections:
             pictures_to_update.append(x.path.name)
+    # Nobody to ask when running on its own so they're left for the next normal run
+    if not interactive:
+        for x in pictures_to_update:
+            print(f'"{x}" has the same time as another photo, run normally to fix it')
+        pictures_to_update = []
     # Get the user to update the datetimes of these (preferably they'd have their phone or wherever they took them to get the correct datetime)
     for x in pictures_to_update:
         while True:
@@ -180,122 +546,765 @@ def checkDates(images, date_corrections, json_fix) -> dict:
             except:
                 print("That time was invalid.")
     # Save these updates for later!
-    with open(json_fix, "w+") as file:
-        json_obj = json.dumps(date_corrections, indent=4, sort_keys=False, default=str)
-        file.write(json_obj)
+    json_obj = json.dumps(date_corrections, indent=4, sort_keys=False, default=str)
+    writeTextFile(json_fix, json_obj)
     return date_corrections
 
 
 # Gets the most common image size
 def getImageSize(images) -> None:
-    size_count = {}
-    # Get the most common image size
-    for x in images:
-        str_match = str(x.width) + " " + str(x.height)
-        if size_count.get(str_match) is None:
-            size_count[str_match] = {"Width": x.width, "Height": x.height, "Count": 1}
-        else:
-            size_count[str_match]["Count"] += 1
-    common_size = ""
-    temp_size = 0
-    for x, y in size_count.items():
-        if y["Count"] > temp_size:
-            common_size = x
-            temp_size = y["Count"]
-    scale_size = (size_count[common_size]["Width"], size_count[common_size]["Height"])
+    # Get the most common image size (the first one found wins a tie)
+    size_count = collections.Counter((x.width, x.height) for x in images)
+    scale_size = size_count.most_common(1)[0][0]
     return scale_size
 
 
-# Create the images
-def createImages(images, temp_directory, scale_size) -> None:
-    font = ImageFont.load_default(size=200)
+# Font for the overlays (loaded once per process)
+overlay_font = None
+
+
+# Gets the font for the overlays
+def getFont():
+    global overlay_font
+    if overlay_font is None:
+        overlay_font = ImageFont.load_default(size=200)
+    return overlay_font
+
+
+# Matching features of the reference photo (found once per process)
+align_reference_features = {}
+
+
+# Reads a photo small and grey for matching, with how much smaller it is than the full size photo
+def getAlignImage(path) -> tuple:
+    with Image.open(path) as im:
+        # Size of the photo once it's been turned by its exif tag
+        full_size = im.size
+        if im.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+            full_size = (full_size[1], full_size[0])
+        im.draft("L", (align_size, align_size))
+        im = ImageOps.exif_transpose(im).convert("L")
+        im.thumbnail((align_size, align_size))
+        gray = np.asarray(im)
+    return gray, (im.size[0] / full_size[0], im.size[1] / full_size[1]), full_size
+
+
+# Finds the features of a grey photo to match (ORB searches a pyramid of smaller copies so it copes with the scale changing)
+def getAlignFeatures(gray) -> tuple:
+    orb = cv2.ORB_create(nfeatures=1000)
+    return orb.detectAndCompute(gray, None)
+
+
+# Works out how to move, turn and scale a photo to line it up with the reference (None if they can't be matched)
+def estimateAlignment(path, reference_path):
+    if reference_path not in align_reference_features:
+        gray, scale, _ = getAlignImage(reference_path)
+        align_reference_features[reference_path] = getAlignFeatures(gray) + (scale,)
+    reference_points, reference_descriptors, reference_scale = align_reference_features[
+        reference_path
+    ]
+    gray, scale, _ = getAlignImage(path)
+    points, descriptors = getAlignFeatures(gray)
+    if descriptors is None or reference_descriptors is None:
+        return None
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+    matches = matcher.match(descriptors, reference_descriptors)
+    # Too few matches to trust
+    if len(matches) < 12:
+        return None
+    source = np.float32([points[m.queryIdx].pt for m in matches])
+    target = np.float32([reference_points[m.trainIdx].pt for m in matches])
+    # Similarity transform that most of the matches agree on
+    matrix, inliers = cv2.estimateAffinePartial2D(
+        source, target, method=cv2.RANSAC, ransacReprojThreshold=3
+    )
+    if matrix is None or inliers.sum() < 12:
+        return None
+    # Measure from the pixel edges like the rest of the transforms (openCV measures from their centres)
+    matrix = getMoveTransform(0.5, 0.5) @ np.vstack([matrix, [0, 0, 1]])
+    matrix = matrix @ getMoveTransform(-0.5, -0.5)
+    # Scale it up from the small copies to the full size photos
+    matrix = (
+        np.linalg.inv(getScaleTransform(*reference_scale))
+        @ matrix
+        @ getScaleTransform(*scale)
+    )
+    return matrix[:2].tolist()
+
+
+# Gets how every photo lines up with the reference (only new photos get matched, the rest are saved from the last run)
+def getAlignments(images, alignment_file) -> dict:
+    reference = images[0]
+    if align_reference != "first":
+        references = [x for x in images if x.path.name == align_reference]
+        if not references:
+            raise ValueError(f"The reference photo {align_reference} wasn't found")
+        reference = references[0]
+    # The saved transforms only hold for the same reference photo and matching size
+    key_data = [reference.file_hash, align_size]
+    transforms = {}
+    reference_size = None
+    if pathlib.Path.exists(alignment_file):
+        with open(alignment_file, "r") as file:
+            saved = json.load(file)
+        if saved["key"] == key_data:
+            transforms = saved["transforms"]
+            reference_size = saved["reference_size"]
+    if reference_size is None:
+        reference_size = getAlignImage(reference.path)[2]
+    transforms[reference.file_hash] = [[1, 0, 0], [0, 1, 0]]
+    # Match the new photos across processes
+    new_images = [x for x in images if x.file_hash not in transforms]
+    if parallel_render and len(new_images) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=render_workers) as pool:
+            matrices = list(
+                pool.map(
+                    estimateAlignment,
+                    [x.path for x in new_images],
+                    itertools.repeat(reference.path),
+                )
+            )
+    else:
+        matrices = [estimateAlignment(x.path, reference.path) for x in new_images]
+    for x, matrix in zip(new_images, matrices):
+        transforms[x.file_hash] = matrix
+    # Save them for the next run (photos that are gone get dropped)
+    transforms = {x.file_hash: transforms[x.file_hash] for x in images}
+    saved = {
+        "key": key_data,
+        "reference_size": list(reference_size),
+        "transforms": transforms,
+    }
+    writeTextFile(alignment_file, json.dumps(saved))
+    # Photos that couldn't be matched are left where they are
+    alignments = {}
+    for file_hash, matrix in transforms.items():
+        if matrix is not None:
+            alignments[file_hash] = (matrix, list(reference_size))
+    return alignments
+
+
+# Levels of each colour that get measured in every photo (the darkest and brightest percent are left out so a few stray pixels don't move them)
+exposure_quantiles = np.linspace(0.01, 0.99, 33)
+
+
+# Measures the levels of each colour in a small copy of a photo
+def getExposureStats(path) -> list:
+    with Image.open(path) as im:
+        im.draft("RGB", (normalize_size, normalize_size))
+        im = im.convert("RGB")
+        im.thumbnail((normalize_size, normalize_size))
+        pixels = np.asarray(im).reshape(-1, 3)
+    return np.quantile(pixels, exposure_quantiles, axis=0).T.round(2).tolist()
+
+
+# Gets the lookup tables that even out every photo's exposure in the order of the photos (only new photos get measured, the rest are saved from the last run)
+def getExposureCorrections(images, exposure_file) -> list:
+    # The saved levels only hold for the same measuring size
+    key_data = [normalize_size]
+    stats = {}
+    if pathlib.Path.exists(exposure_file):
+        with open(exposure_file, "r") as file:
+            saved = json.load(file)
+        if saved["key"] == key_data:
+            stats = saved["stats"]
+    # Measure the new photos across processes
+    new_images = [x for x in images if x.file_hash not in stats]
+    if parallel_render and len(new_images) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=render_workers) as pool:
+            measured = list(pool.map(getExposureStats, [x.path for x in new_images]))
+    else:
+        measured = [getExposureStats(x.path) for x in new_images]
+    for x, levels in zip(new_images, measured):
+        stats[x.file_hash] = levels
+    # Save them for the next run (photos that are gone get dropped)
+    stats = {x.file_hash: stats[x.file_hash] for x in images}
+    writeTextFile(exposure_file, json.dumps({"key": key_data, "stats": stats}))
+    # The levels each photo should have are the average over the days around it (a running sum so it's the same work for any window)
+    levels = np.array([stats[x.file_hash] for x in images])
+    totals = np.concatenate([np.zeros((1,) + levels.shape[1:]), levels.cumsum(axis=0)])
+    n = np.arange(len(images))
+    starts = np.maximum(n - normalize_window, 0)
+    ends = np.minimum(n + normalize_window + 1, len(images))
+    targets = (totals[ends] - totals[starts]) / (ends - starts)[:, None, None]
+    # Map each photo's levels onto the target ones (black and white stay put so nothing clips)
+    ramp = np.arange(256)
+    corrections = []
+    for photo_levels, target_levels in zip(levels, targets):
+        lut = np.empty((1, 256, 3), np.uint8)
+        for channel in range(3):
+            # Levels kept inside the ends so photos with blown highlights or crushed shadows don't move them
+            source = np.clip(photo_levels[channel], 0.5, 254.5)
+            source = np.concatenate([[0], source, [255]])
+            target = np.concatenate([[0], target_levels[channel], [255]])
+            # The mapping needs the levels to go up so repeats (flat or clipped photos) only keep their first one
+            keep = np.concatenate([[True], np.diff(source) > 0])
+            curve = np.interp(ramp, source[keep], target[keep])
+            curve = ramp + (curve - ramp) * normalize_strength
+            lut[0, :, channel] = np.clip(curve.round(), 0, 255)
+        corrections.append(lut)
+    return corrections
+
+
+# Gets the transform that moves pixels (the transforms measure from the edges of the pixels so (0, 0) is the top left corner of the photo)
+def getMoveTransform(x, y) -> np.ndarray:
+    return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]])
+
+
+# Gets the transform that scales pixels
+def getScaleTransform(scale_x, scale_y) -> np.ndarray:
+    return np.array([[scale_x, 0, 0], [0, scale_y, 0], [0, 0, 1]])
+
+
+# Pillow's transposes for each exif orientation
+exif_transposes = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+# Gets the transform that turns a photo upright from its exif orientation (size is before it's turned)
+def getOrientationTransform(orientation, size) -> np.ndarray:
+    w, h = size
+    matrices = {
+        2: [[-1, 0, w], [0, 1, 0]],
+        3: [[-1, 0, w], [0, -1, h]],
+        4: [[1, 0, 0], [0, -1, h]],
+        5: [[0, 1, 0], [1, 0, 0]],
+        6: [[0, -1, h], [1, 0, 0]],
+        7: [[0, -1, h], [-1, 0, w]],
+        8: [[0, 1, 0], [-1, 0, w]],
+    }
+    if orientation not in matrices:
+        return np.eye(3)
+    return np.vstack([matrices[orientation], [0, 0, 1]])
+
+
+# Gets the transform from a full size upright photo to its frame (lined up with the reference, rotated, then covering the frame)
+def getFrameTransform(size, scale_size, alignment) -> np.ndarray:
+    transform = np.eye(3)
+    # Line it up with the reference photo (it's then the reference's size)
+    if alignment is not None:
+        matrix, size = alignment
+        transform = np.vstack([matrix, [0, 0, 1]])
+    # Rotate around the middle like Pillow does
+    if rotate_image != 0:
+        rotation = cv2.getRotationMatrix2D((size[0] / 2, size[1] / 2), rotate_image, 1)
+        transform = np.vstack([rotation, [0, 0, 1]]) @ transform
+    # Scale it to cover the frame (zoomed in a little when lining up)
+    scale = max(scale_size[0] / size[0], scale_size[1] / size[1])
+    if align_photos:
+        scale *= align_zoom
+    transform = getScaleTransform(scale, scale) @ transform
+    # Crop the overhang off evenly
+    overhang = getMoveTransform(
+        (scale_size[0] - size[0] * scale) / 2, (scale_size[1] - size[1] * scale) / 2
+    )
+    return overhang @ transform
+
+
+# Turns a photo upright, lines it up, rotates, scales and crops it to the frame with a single resample
+# full_size is the size of the upright photo before any draft decoding
+def warpImage(im, orientation, full_size, scale_size, alignment) -> Image.Image:
+    if im.mode not in ("RGB", "L"):
+        im = im.convert("RGB")
+    # From the pixels as they were decoded to the frame
+    upright_size = im.size
+    if orientation in (5, 6, 7, 8):
+        upright_size = (im.size[1], im.size[0])
+    transform = getFrameTransform(full_size, scale_size, alignment)
+    transform = transform @ getScaleTransform(
+        full_size[0] / upright_size[0], full_size[1] / upright_size[1]
+    )
+    transform = transform @ getOrientationTransform(orientation, im.size)
+    # Only scaling and cropping left so Pillow does it in one resize of the part that's kept (the same filter
+    # ImageOps.cover uses) and the smaller result gets turned upright (transposing doesn't resample)
+    if alignment is None and rotate_image == 0:
+        corners = np.linalg.inv(transform) @ [
+            [0, scale_size[0]],
+            [0, scale_size[1]],
+            [1, 1],
+        ]
+        box = (
+            corners[0].min(),
+            corners[1].min(),
+            corners[0].max(),
+            corners[1].max(),
+        )
+        resize_size = scale_size
+        if orientation in (5, 6, 7, 8):
+            resize_size = (scale_size[1], scale_size[0])
+        # Nothing to do if it's already the right size
+        if resize_size != im.size or not np.allclose(box, (0, 0) + im.size):
+            im = im.resize(resize_size, Image.Resampling.BICUBIC, box=box)
+        if orientation in exif_transposes:
+            im = im.transpose(exif_transposes[orientation])
+    else:
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        # The warp doesn't filter so big reductions get shrunk by a whole number first (which averages the pixels)
+        factor = int(1 / abs(np.linalg.det(transform[:2, :2])) ** 0.5)
+        if factor > 1:
+            im = im.reduce(factor)
+            transform = transform @ getScaleTransform(factor, factor)
+        # openCV measures from the pixel centres
+        transform = getMoveTransform(-0.5, -0.5) @ transform
+        transform = transform @ getMoveTransform(0.5, 0.5)
+        frame = cv2.warpAffine(
+            np.asarray(im), transform[:2], scale_size, flags=cv2.INTER_CUBIC
+        )
+        im = Image.fromarray(frame)
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    return im
+
+
+# Gets the name a frame is stored under in the render cache and temp folder (so a frame that's already there is the same one)
+def getFrameName(
+    path,
+    file_hash,
+    day,
+    date_to_use,
+    scale_size,
+    alignment=None,
+    lut=None,
+) -> str:
+    # Everything that changes how the frame looks goes into the key
+    key_data = [
+        file_hash,
+        day,
+        date_to_use,
+        add_day_count,
+        add_date,
+        add_text_boxes,
+        rotate_image,
+        list(scale_size),
+    ]
+    # Only added when lining up so frames cached without it stay valid
+    if align_photos:
+        key_data += [align_zoom, alignment]
+    # Same for evening out the exposure
+    if normalize_exposure:
+        key_data += [hashlib.sha256(lut.tobytes()).hexdigest()]
+    key = hashlib.sha256(json.dumps(key_data).encode()).hexdigest()
+    # Keep the extension so the frame is saved the same way as the photo
+    return key + path.suffix
+
+
+# Everything needed to render one frame
+FrameJob = collections.namedtuple(
+    "FrameJob",
+    ["path", "day", "date_to_use", "cache_path", "alignment", "lut", "frame_name"],
+)
+
+
+# Gets the day number, date, cache path, alignment, exposure correction and name of every frame
+def getFrameJobs(
+    images, scale_size, cache_directory, alignments=None, corrections=None
+) -> list:
     # Get the first date
     if specific_first_date is None:
         first_date = images[0].creation.date()
     else:
         first_date = specific_first_date
-    # Resizing the images
+    jobs = []
     for n, x in enumerate(images):
-        with Image.open(x.path) as im:
-            name = pathlib.Path.joinpath(temp_directory, x.path.name)
-            # Sets the image to follow the transposing in the exif tag
-            im = ImageOps.exif_transpose(im)
-            # Rotate if we are rotating
-            if rotate_image != 0:
-                im = im.rotate(rotate_image)
-            # Resize the image
-            if im.size != scale_size:
-                im = ImageOps.cover(im, scale_size)
-            draw = ImageDraw.Draw(im, "RGBA")
-            # Add day counter
-            if add_day_count:
-                day_string = f"Day: {n+1}"
-                day_string_length = len(day_string) - 5
-                polygon_width = 525 + (day_string_length * 115)
-                if add_text_boxes:
-                    draw.polygon(
-                        [
-                            (35, 25),
-                            (35, 245),
-                            (polygon_width, 245),
-                            (polygon_width, 25),
-                        ],
-                        fill=(255, 255, 255, 75),
-                    )
-                draw.text(
-                    (50, -5),
-                    day_string,
-                    font=font,
-                    fill=(0, 0, 0, 100),
-                    anchor="la",
+        date_to_use = str(x.creation.date())
+        if use_cheat_day:
+            date_to_use = str(first_date + datetime.timedelta(days=n))
+        alignment = None
+        if alignments is not None:
+            alignment = alignments.get(x.file_hash)
+        lut = None
+        if corrections is not None:
+            lut = corrections[n]
+        frame_name = getFrameName(
+            x.path, x.file_hash, n + 1, date_to_use, scale_size, alignment, lut
+        )
+        cache_path = None
+        if cache_directory is not None:
+            cache_path = pathlib.Path.joinpath(cache_directory, frame_name)
+            cache_path = cache_path.with_suffix(".npy")
+        jobs.append(
+            FrameJob(x.path, n + 1, date_to_use, cache_path, alignment, lut, frame_name)
+        )
+    return jobs
+
+
+# Removes cached frames that no longer match a photo or the settings
+def cleanRenderCache(jobs, cache_directory) -> None:
+    if cache_directory is None:
+        return
+    wanted = set(job.cache_path for job in jobs)
+    for cached in cache_directory.iterdir():
+        if cached not in wanted:
+            cached.unlink()
+
+
+# Removes frames in the temp folder that no longer match a photo or the settings (along with any half written ones)
+def cleanTempFrames(jobs, temp_directory) -> None:
+    wanted = set(job.frame_name for job in jobs)
+    for temp_file in temp_directory.iterdir():
+        if temp_file.is_file() and temp_file.name not in wanted:
+            temp_file.unlink()
+
+
+# Gets the name a file is written under until it's finished
+def getPartPath(path) -> pathlib.Path:
+    return path.with_name(path.stem + ".part" + path.suffix)
+
+
+# Writes a text file under another name first so a killed run can't leave half of it behind
+def writeTextFile(path, text) -> None:
+    part_path = getPartPath(path)
+    with open(part_path, "w+") as file:
+        file.write(text)
+    os.replace(part_path, path)
+
+
+# Saves a frame (written under another name first so a killed run can't leave half a frame behind)
+def saveImageFile(im, path) -> None:
+    part_path = getPartPath(path)
+    im.save(part_path)
+    os.replace(part_path, path)
+
+
+# Saves a rendered frame's pixels for the render cache the same way (raw so nothing is lost)
+def saveFrameFile(im, path) -> None:
+    part_path = getPartPath(path)
+    with open(part_path, "wb") as file:
+        np.save(file, np.asarray(im))
+    os.replace(part_path, path)
+
+
+# Swaps an image for the next step's copy (closing the old one straight away when saving memory)
+def replaceImage(im, new_im) -> Image.Image:
+    if low_memory and new_im is not im:
+        im.close()
+    return new_im
+
+
+# Renders a single frame
+def renderImage(job, scale_size, data=None) -> Image.Image:
+    path, day, date_to_use, cache_path, alignment, lut, _ = job
+    font = getFont()
+    # Open from memory if the photo was already read
+    if data is not None:
+        path = io.BytesIO(data)
+    with Image.open(path) as im:
+        # Which way the photo needs turning to be upright (from the exif tag) and its size once it is
+        orientation = im.getexif().get(ExifTags.Base.Orientation, 1)
+        full_size = im.size
+        if orientation in (5, 6, 7, 8):
+            full_size = (full_size[1], full_size[0])
+        # Turn it upright, line it up, rotate, scale and crop it all at once (the overlays are drawn in RGB so it's that too)
+        im = replaceImage(
+            im, warpImage(im, orientation, full_size, scale_size, alignment)
+        )
+        # Even out the exposure before the overlays go on
+        if lut is not None:
+            im = replaceImage(im, Image.fromarray(cv2.LUT(np.asarray(im), lut)))
+        draw = ImageDraw.Draw(im, "RGBA")
+        # Add day counter
+        if add_day_count:
+            day_string = f"Day: {day}"
+            day_string_length = len(day_string) - 5
+            polygon_width = 525 + (day_string_length * 115)
+            if add_text_boxes:
+                draw.polygon(
+                    [
+                        (35, 25),
+                        (35, 245),
+                        (polygon_width, 245),
+                        (polygon_width, 25),
+                    ],
+                    fill=(255, 255, 255, 75),
                 )
-            if add_date:
-                if add_text_boxes:
-                    draw.polygon(
-                        [
-                            (im.size[0] - 35, im.size[1] - 25),
-                            (im.size[0] - 35, im.size[1] - 245),
-                            (im.size[0] - 1100, im.size[1] - 245),
-                            (im.size[0] - 1100, im.size[1] - 25),
-                        ],
-                        fill=(255, 255, 255, 75),
-                    )
-                date_to_use = str(x.creation.date())
-                if use_cheat_day:
-                    date_to_use = first_date + datetime.timedelta(days=n)
-                draw.text(
-                    (im.size[0] - 50, im.size[1] - 72),
-                    f"{date_to_use}",
-                    font=font,
-                    fill=(0, 0, 0, 100),
-                    anchor="rs",
+            draw.text(
+                (50, -5),
+                day_string,
+                font=font,
+                fill=(0, 0, 0, 100),
+                anchor="la",
+            )
+        if add_date:
+            if add_text_boxes:
+                draw.polygon(
+                    [
+                        (im.size[0] - 35, im.size[1] - 25),
+                        (im.size[0] - 35, im.size[1] - 245),
+                        (im.size[0] - 1100, im.size[1] - 245),
+                        (im.size[0] - 1100, im.size[1] - 25),
+                    ],
+                    fill=(255, 255, 255, 75),
                 )
-            # Save the image
-            im.save(name)
+            draw.text(
+                (im.size[0] - 50, im.size[1] - 72),
+                date_to_use,
+                font=font,
+                fill=(0, 0, 0, 100),
+                anchor="rs",
+            )
+        # Make sure the pixels are loaded before the source file is closed
+        im.load()
+    return im
+
+
+# Renders a single frame and saves it
+def saveImage(job, temp_directory, scale_size) -> tuple:
+    start = time.perf_counter()
+    name = pathlib.Path.joinpath(temp_directory, job.frame_name)
+    cache_path = job.cache_path
+    # Already saved by a run that stopped part way
+    if name.exists():
+        return (time.perf_counter() - start, 0, 0)
+    # Use the cached frame if there is one
+    if cache_path is not None and cache_path.exists():
+        with Image.fromarray(np.load(cache_path)) as im:
+            saveImageFile(im, name)
+        bytes_read = cache_path.stat().st_size
+        return (time.perf_counter() - start, bytes_read, name.stat().st_size)
+    im = renderImage(job, scale_size)
+    bytes_written = 0
+    if cache_path is not None:
+        saveFrameFile(im, cache_path)
+        bytes_written += cache_path.stat().st_size
+    saveImageFile(im, name)
+    bytes_written += name.stat().st_size
+    # Return how long it took and how much was read and written for the report
+    return (time.perf_counter() - start, job.path.stat().st_size, bytes_written)
+
+
+# Reads the file a frame is made from (the cached frame if there is one)
+def readFrameSource(job) -> tuple:
+    cache_path = job.cache_path
+    cached = cache_path is not None and cache_path.exists()
+    with open(cache_path if cached else job.path, "rb") as file:
+        return cached, file.read()
+
+
+# Renders a single frame as an array openCV can write
+def renderFrame(job, scale_size, source=None) -> tuple:
+    start = time.perf_counter()
+    cache_path = job.cache_path
+    # Read the file here if a reader thread didn't already
+    if source is None:
+        source = readFrameSource(job)
+    cached, data = source
+    # Use the cached frame if there is one
+    if cached:
+        frame = cv2.cvtColor(np.load(io.BytesIO(data)), cv2.COLOR_RGB2BGR)
+        return frame, (time.perf_counter() - start, len(data), 0)
+    im = renderImage(job, scale_size, data)
+    bytes_written = 0
+    if cache_path is not None:
+        saveFrameFile(im, cache_path)
+        bytes_written = cache_path.stat().st_size
+    # Already RGB from renderImage
+    frame = cv2.cvtColor(np.asarray(im), cv2.COLOR_RGB2BGR)
+    if low_memory:
+        im.close()
+    # Also return how long it took and how much was read and written for the report
+    stats = (time.perf_counter() - start, len(data), bytes_written)
+    return frame, stats
+
+
+# Reads a frame's file on a reader thread then hands it to a render process
+def submitFrame(readers, pool, job, scale_size) -> concurrent.futures.Future:
+    rendered = concurrent.futures.Future()
+
+    # Passes the render's result on to the frame
+    def finishRender(render):
+        if render.exception() is not None:
+            rendered.set_exception(render.exception())
+        else:
+            rendered.set_result(render.result())
+
+    # Starts the render once the file has been read
+    def startRender(read):
+        try:
+            render = pool.submit(renderFrame, job, scale_size, read.result())
+        except Exception as e:
+            rendered.set_exception(e)
+            return
+        render.add_done_callback(finishRender)
+
+    readers.submit(readFrameSource, job).add_done_callback(startRender)
+    return rendered
+
+
+# Waits for a frame and records it for the report
+def takeFrame(rendered) -> np.ndarray:
+    frame, stats = rendered.result()
+    recordFrame(stats)
+    return frame
+
+
+# Renders the frames in order without saving them to the temp folder
+def renderFrames(jobs, scale_size, parallel=True):
+    # Reader threads, then render processes, then the frames go to the video in order
+    if parallel and parallel_render and len(jobs) > 1:
+        # Cap the frames in the pipeline so memory doesn't grow with the library
+        in_flight_limit = max_frames_in_flight
+        if in_flight_limit is None:
+            in_flight_limit = (render_workers or os.cpu_count() or 1) * 2
+            # One frame per render process when saving memory
+            if low_memory:
+                in_flight_limit = render_workers or os.cpu_count() or 1
+        # The readers get shut down before the render processes
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=render_workers
+        ) as pool, concurrent.futures.ThreadPoolExecutor(
+            max_workers=reader_threads
+        ) as readers:
+            in_flight = collections.deque()
+            for job in jobs:
+                in_flight.append(submitFrame(readers, pool, job, scale_size))
+                # When the pipeline is full wait on the oldest frame (the video needs them in order anyway)
+                if len(in_flight) >= in_flight_limit:
+                    yield takeFrame(in_flight.popleft())
+            while in_flight:
+                yield takeFrame(in_flight.popleft())
+    # Render the frames one at a time
+    else:
+        for job in jobs:
+            frame, stats = renderFrame(job, scale_size)
+            recordFrame(stats)
+            yield frame
+
+
+# Create the images
+def createImages(jobs, temp_directory, scale_size, parallel=True) -> None:
+    # Render the images across processes (every job already knows its day and date so the order doesn't matter)
+    if parallel and parallel_render and len(jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=render_workers) as pool:
+            # Consume the results so any errors get raised here
+            for stats in pool.map(
+                saveImage,
+                jobs,
+                itertools.repeat(temp_directory),
+                itertools.repeat(scale_size),
+                chunksize=4,
+            ):
+                recordFrame(stats)
+    # Render the images one at a time
+    else:
+        for job in jobs:
+            recordFrame(saveImage(job, temp_directory, scale_size))
+
+
+# Reads the created images back from the temp folder
+def readImages(jobs, temp_directory):
+    for job in jobs:
+        # Get name of the image for a frame
+        name = pathlib.Path.joinpath(temp_directory, job.frame_name)
+        run_report["bytes_read"] += name.stat().st_size
+        # Read the image with openCV
+        yield cv2.imread(name)
+
+
+# Gets the frame rate of the video and how many times each frame gets written to it
+def getFrameTiming() -> tuple:
+    # Crossfading already makes every frame of the video
+    if crossfade_frames > 0:
+        return fractions.Fraction(fps), 1
+    # Add each photo once and lower the frame rate so it stays on screen just as long
+    if hold_frames:
+        return fractions.Fraction(fps, length_per_image), 1
+    # Or add it for however many frames we want per image
+    return fractions.Fraction(fps), length_per_image
+
+
+# Fades each photo into the next over the last crossfade_frames frames of its time on screen
+# Only the photo before is kept so every photo is still only rendered once (with fade_into_last the last frame is only there to fade into)
+def blendFrames(frames, fade_into_last=False):
+    if crossfade_frames >= length_per_image:
+        raise ValueError("crossfade_frames has to be less than length_per_image")
+    previous = None
+    for frame in frames:
+        if previous is not None:
+            for i in range(length_per_image - crossfade_frames):
+                yield previous
+            for i in range(crossfade_frames):
+                weight = (i + 1) / (crossfade_frames + 1)
+                yield cv2.addWeighted(previous, 1 - weight, frame, weight, 0)
+        previous = frame
+    # The last photo is held for its whole time
+    if previous is not None and not fade_into_last:
+        for i in range(length_per_image):
+            yield previous
 
 
 # Creates the timelapse video
-def createVideo(images, output_directory, temp_directory, scale_size) -> None:
+def createVideo(frames, video_out, scale_size) -> None:
+    video_fps, repeats = getFrameTiming()
     output_video = cv2.VideoWriter(
-        pathlib.Path.joinpath(output_directory, "timelapse.mp4"),
+        video_out,
         fourcc=cv2.VideoWriter_fourcc(*"mp4v"),
-        fps=fps,
+        fps=float(video_fps),
         frameSize=scale_size,
     )
     # Creating a video using opencv
-    for x in images:
-        # Get name of the image for a frame
-        name = pathlib.Path.joinpath(temp_directory, x.path.name)
-        # Read the image with openCV
-        img = cv2.imread(name)
-        # For however many frames we want per image add it to the video
-        for i in range(length_per_image):
+    for img in frames:
+        for i in range(repeats):
             output_video.write(img)
     # Don't think I have any windows, but might as well make sure
     cv2.destroyAllWindows()
     output_video.release()
 
 
+# Loads the record of which stages the last runs finished and what they made
+def loadCheckpoints(checkpoint_file) -> dict:
+    if pathlib.Path.exists(checkpoint_file):
+        with open(checkpoint_file, "r") as file:
+            return json.load(file)
+    return {}
+
+
+# Gets the key for everything a stage's outputs depend on
+def getStageKey(key_data) -> str:
+    return hashlib.sha256(json.dumps(key_data).encode()).hexdigest()
+
+
+# Checks if a stage was already finished with the same inputs and its outputs haven't been changed or removed since
+def isStageDone(checkpoints, stage, key) -> bool:
+    saved = checkpoints.get(stage)
+    if saved is None or saved["key"] != key:
+        return False
+    for output, (size, modified) in saved["outputs"].items():
+        output = pathlib.Path(output)
+        if not pathlib.Path.exists(output):
+            return False
+        stat = output.stat()
+        if stat.st_size != size or stat.st_mtime_ns != modified:
+            return False
+    return True
+
+
+# Records that a stage finished and what it made
+def finishStage(checkpoints, checkpoint_file, stage, key, outputs) -> None:
+    checkpoints[stage] = {
+        "key": key,
+        "outputs": {
+            str(output): [output.stat().st_size, output.stat().st_mtime_ns]
+            for output in outputs
+        },
+    }
+    writeTextFile(checkpoint_file, json.dumps(checkpoints, indent=4))
+
+
+# Gets the key for everything the video depends on (the frame names already cover the photos and how they're drawn)
+def getVideoKey(jobs, scale_size) -> str:
+    key_data = [job.frame_name for job in jobs]
+    key_data += [fps, length_per_image, hold_frames, crossfade_frames]
+    return getStageKey(key_data + [list(scale_size)])
+
+
 # Deletes files after
 def deleteAfter(temp_directory, photo_directory):
     if delete_temp:
@@ -304,50 +1313,259 @@ def deleteAfter(temp_directory, photo_directory):
         shutil.rmtree(photo_directory)
 
 
-# Main function for running everything
-def main() -> None:
+# Runs every stage of the timelapse
+def runPipeline(root, interactive=True) -> None:
+    # Start a new report
+    resetReport()
+
     # Get the path for the photos
-    root = pathlib.Path().resolve()
     photo_directory = pathlib.Path.joinpath(root, "photos")
     output_directory = pathlib.Path.joinpath(root, "timelapse")
     temp_directory = pathlib.Path.joinpath(root, "temp")
+    render_cache_directory = None
+    if use_render_cache:
+        render_cache_directory = pathlib.Path.joinpath(root, "render_cache")
     json_fix = pathlib.Path.joinpath(root, "corrections.json")
+    image_index = pathlib.Path.joinpath(root, "image_index.json")
+    alignment_file = pathlib.Path.joinpath(root, "alignment.json")
+    exposure_file = pathlib.Path.joinpath(root, "exposure.json")
+    checkpoint_file = pathlib.Path.joinpath(root, "checkpoints.json")
 
     # Create future directories
     if not pathlib.Path.exists(output_directory):
         pathlib.Path.mkdir(output_directory)
     if not pathlib.Path.exists(temp_directory):
         pathlib.Path.mkdir(temp_directory)
+    if use_render_cache and not pathlib.Path.exists(render_cache_directory):
+        pathlib.Path.mkdir(render_cache_directory)
 
     # Get the date corrections if there are any
     date_corrections = getDateCorrections(json_fix)
 
     # Get the images
-    images = getImages(photo_directory)
+    with timeStage("getImages"):
+        images = getImages(photo_directory, image_index)
 
-    # Check Dates
-    date_corrections = checkDates(images, date_corrections, json_fix)
-
-    # Fix the images again for any new issues
+    # Use the dates that are already known to be right before comparing any of them
     images = fixPhotoDates(images, date_corrections, root)
 
-    # Sorting the images by their date (defined in the class __lt__ method)
-    images.sort()
+    # Leave out near duplicates before the dates get checked so they aren't asked about
+    if remove_duplicates:
+        with timeStage("removeDuplicates"):
+            images = removeDuplicates(images)
+
+    with timeStage("checkDates"):
+        # Check Dates
+        date_corrections = checkDates(images, date_corrections, json_fix, interactive)
+
+        # Fix the images again for any new issues
+        images = fixPhotoDates(images, date_corrections, root)
+
+        # Sorting the images by their date (defined in the class __lt__ method)
+        images.sort()
+
+    # Hash the contents of the photos now that it's known which are used
+    with timeStage("hashImages"):
+        hashImages(images, image_index)
+
+    # Work out how each photo lines up with the reference
+    alignments = None
+    if align_photos:
+        with timeStage("getAlignments"):
+            alignments = getAlignments(images, alignment_file)
+
+    # Work out how to even out each photo's exposure with the days around it
+    corrections = None
+    if normalize_exposure:
+        with timeStage("getExposureCorrections"):
+            corrections = getExposureCorrections(images, exposure_file)
+
+    with timeStage("getFrameJobs"):
+        # Gets the most common image size for scaling
+        scale_size = getImageSize(images)
+
+        # Work out the day, date and cache path of every frame
+        jobs = getFrameJobs(
+            images, scale_size, render_cache_directory, alignments, corrections
+        )
+
+        # Remove cached frames that no longer match a photo or the settings
+        cleanRenderCache(jobs, render_cache_directory)
 
-    # Gets the most common image size for scaling
-    scale_size = getImageSize(images)
+        # Same for frames left in the temp folder by the last run
+        cleanTempFrames(jobs, temp_directory)
+
+    # Skip the video if the last run already made it from the same frames
+    checkpoints = loadCheckpoints(checkpoint_file)
+    video_out = pathlib.Path.joinpath(output_directory, "timelapse.mp4")
+    video_key = getVideoKey(jobs, scale_size)
+    if isStageDone(checkpoints, "createVideo", video_key):
+        run_report["skipped"].append("createVideo")
+    else:
+        # Render the frames straight into the video (the rendering gets timed with the video)
+        if stream_frames:
+            frames = renderFrames(jobs, scale_size)
+        # Create all the images for the timelapse and read them back for the video (frames a stopped run saved are kept)
+        else:
+            with timeStage("createImages"):
+                createImages(jobs, temp_directory, scale_size)
+            frames = readImages(jobs, temp_directory)
 
-    # Create all the images for the timelapse
-    createImages(images, temp_directory, scale_size)
+        # Fade between the photos as the frames go into the video
+        if crossfade_frames > 0:
+            frames = blendFrames(frames)
 
-    # Create the timelapse video
-    createVideo(images, output_directory, temp_directory, scale_size)
+        # Create the timelapse video (only replacing the last one once it's finished)
+        with timeStage("createVideo"):
+            part_out = getPartPath(video_out)
+            createVideo(frames, part_out, scale_size)
+            os.replace(part_out, video_out)
+        finishStage(checkpoints, checkpoint_file, "createVideo", video_key, [video_out])
 
     # Delete files after if enabled
-    deleteAfter(temp_directory, photo_directory)
+    with timeStage("deleteAfter"):
+        deleteAfter(temp_directory, photo_directory)
+
+
+# inotify events for a file being finished, moved in or out, or deleted
+inotify_mask = 0x8 | 0x40 | 0x80 | 0x200
+# inotify event for events being dropped because too many came in at once
+inotify_overflow = 0x4000
+
+
+# Opens inotify on the folders (None if it isn't available)
+def openInotify(directories):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        # Closed if the process is replaced
+        fd = libc.inotify_init1(0o2000000)
+    except (OSError, AttributeError, TypeError):
+        return None
+    if fd < 0:
+        return None
+    for directory in directories:
+        if libc.inotify_add_watch(fd, str(directory).encode(), inotify_mask) < 0:
+            os.close(fd)
+            return None
+    return fd
+
+
+# Waits for photos in folders to change (with inotify on Linux, or by checking the folders every so often anywhere else)
+class FolderWatcher:
+    # Set it up
+    def __init__(self, directories, suffixes) -> None:
+        self.directories = directories
+        self.suffixes = suffixes
+        self.fd = openInotify(directories)
+        self.snapshot = self.getSnapshot()
+
+    # Gets the size and modified time of every file being watched
+    def getSnapshot(self) -> dict:
+        snapshot = {}
+        for directory in self.directories:
+            for x in directory.iterdir():
+                if x.suffix not in self.suffixes:
+                    continue
+                # It may have been removed since the folder was listed
+                try:
+                    stat = x.stat()
+                except FileNotFoundError:
+                    continue
+                snapshot[x] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    # Reads what inotify has and checks if any of it was a file being watched
+    def readEvents(self) -> bool:
+        data = os.read(self.fd, 64 * 1024)
+        changed = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16 : offset + 16 + length].rstrip(b"\0")
+            offset += 16 + length
+            if mask & inotify_overflow:
+                changed = True
+            elif pathlib.Path(name.decode(errors="replace")).suffix in self.suffixes:
+                changed = True
+        return changed
+
+    # Waits for a change (True) or for the timeout to run out (False), None waits forever
+    def wait(self, timeout=None) -> bool:
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            if self.fd is not None:
+                ready, _, _ = select.select([self.fd], [], [], remaining)
+                if ready and self.readEvents():
+                    return True
+            else:
+                sleep = watch_poll_interval
+                if remaining is not None:
+                    sleep = min(sleep, remaining)
+                time.sleep(sleep)
+                snapshot = self.getSnapshot()
+                if snapshot != self.snapshot:
+                    self.snapshot = snapshot
+                    return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+
+# Remakes the timelapse whenever the photos change (only the new or changed photos get read and rendered again)
+def watchFolders(root) -> None:
+    photo_directory = pathlib.Path.joinpath(root, "photos")
+    output_directory = pathlib.Path.joinpath(root, "timelapse")
+    directories = [x for x in [photo_directory] if pathlib.Path.exists(x)]
+    watcher = FolderWatcher(directories, (".jpg", ".png"))
+    print("Watching for new photos")
+    while True:
+        watcher.wait()
+        # Wait for the changes to stop so a burst of them is one update
+        while watcher.wait(watch_debounce):
+            pass
+        # Keep watching if a run fails (like a photo that's still being copied in)
+        try:
+            runPipeline(root, interactive=False)
+        except Exception as e:
+            print(f"Making the timelapse failed: {e!r}")
+            continue
+        if write_report:
+            writeReport(output_directory)
+        print(f"Timelapse updated at {datetime.datetime.now():%H:%M:%S}")
+
+
+# Main function for running everything
+def main() -> None:
+    root = pathlib.Path().resolve()
+    output_directory = pathlib.Path.joinpath(root, "timelapse")
+    # Start profiling if enabled
+    if profile_mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile_mode == "tracemalloc":
+        tracemalloc.start()
+
+    # Make the timelapse
+    runPipeline(root, interactive=not watch_mode)
+
+    # Save the profile and report
+    if profile_mode == "cprofile":
+        profiler.disable()
+        profiler.dump_stats(pathlib.Path.joinpath(output_directory, "profile.prof"))
+    if write_report:
+        writeReport(output_directory)
+
+    # Keep remaking it as photos come in
+    if watch_mode:
+        watchFolders(root)
 
 
-# Run the main loop
-main()
+# Run the main loop (guarded so the render processes don't run it again)
+if __name__ == "__main__":
+    main()
 
 # endregion Code